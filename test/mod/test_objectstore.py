@@ -3,17 +3,192 @@
 #
 
 import contextlib
+import itertools
 import os
 import shutil
 import tempfile
 import unittest
-from pathlib import Path
 
 from osbuild import objectstore
 
 from .. import test
 
 
+def is_empty(path):
+    with os.scandir(path) as it:
+        return next(it, None) is None
+
+
+def has_entries(path, count):
+    # stop after one more entry than expected, so that
+    # big directories do not need to be listed in full
+    with os.scandir(path) as it:
+        return sum(1 for _ in itertools.islice(it, count + 1)) == count
+
+
+def touch(path):
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o644))
+
+
+def read_raw(path, size=16):
+    """Read up to `size` bytes from `path` with a single read(2)"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, size)
+    finally:
+        os.close(fd)
+
+
+def store_path(store, ref, path):
+    """Check if `path` exists in the tree committed as `ref`"""
+    try:
+        fd = os.open(store.resolve_ref(ref), os.O_RDONLY | os.O_DIRECTORY)
+    except FileNotFoundError:
+        return False
+    try:
+        os.stat(path, dir_fd=fd)
+    except FileNotFoundError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+
+@unittest.skipUnless(test.TestBase.can_bind_mount(), "root-only")
+class TestObjectStoreFresh(unittest.TestCase):
+    """Tests that need an empty store, e.g. so item counting works"""
+
+    def setUp(self):
+        self.store = tempfile.mkdtemp(prefix="osbuild-test-", dir="/var/tmp")
+        self.object_store = objectstore.ObjectStore(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.store)
+
+    def test_basic(self):
+        object_store = self.object_store
+        # No objects or references should be in the store
+        assert is_empty(object_store.refs)
+        assert is_empty(object_store.objects)
+
+        with object_store.new() as tree:
+            with tree.write() as path:
+                touch(os.path.join(path, "A"))
+            object_store.commit(tree, "a")
+
+        assert object_store.contains("a")
+        assert os.path.exists(f"{object_store.refs}/a")
+        assert store_path(object_store, "a", "A")
+        assert has_entries(object_store.refs, 1)
+        assert has_entries(object_store.objects, 1)
+        assert has_entries(f"{object_store.refs}/a/", 1)
+
+        with object_store.new() as tree:
+            with tree.write() as path:
+                touch(os.path.join(path, "A"))
+                touch(os.path.join(path, "B"))
+            object_store.commit(tree, "b")
+
+        assert object_store.contains("b")
+        assert os.path.exists(f"{object_store.refs}/b")
+
+        assert has_entries(object_store.refs, 2)
+        assert has_entries(object_store.objects, 2)
+
+        # verify the content of "b" with a single directory read
+        with os.scandir(object_store.resolve_ref("b")) as it:
+            names = {e.name for e in it}
+        assert names == {"A", "B"}
+
+        self.assertEqual(object_store.resolve_ref(None), None)
+        self.assertEqual(object_store.resolve_ref("a"),
+                         f"{object_store.refs}/a")
+
+    def test_cleanup(self):
+        with self.object_store as object_store:
+            tree = object_store.new()
+            self.assertTrue(has_entries(object_store.tmp, 1))
+            with tree.write() as path:
+                touch(os.path.join(path, "A"))
+        # there should be no temporary Objects dirs anymore
+        self.assertTrue(is_empty(object_store.tmp))
+
+    def test_object_base(self):
+        object_store = self.object_store
+        with object_store.new() as tree:
+            with tree.write() as path:
+                touch(os.path.join(path, "A"))
+            object_store.commit(tree, "a")
+
+        with object_store.new() as tree:
+            tree.base = "a"
+            object_store.commit(tree, "b")
+
+        with object_store.new() as tree:
+            tree.base = "b"
+            with tree.write() as path:
+                touch(os.path.join(path, "C"))
+            object_store.commit(tree, "c")
+
+        assert store_path(object_store, "a", "A")
+        assert store_path(object_store, "b", "A")
+        assert store_path(object_store, "c", "A")
+        assert store_path(object_store, "c", "C")
+
+        assert has_entries(object_store.refs, 3)
+        assert has_entries(object_store.objects, 3)
+
+    def test_object_copy_on_write(self):
+        # sample data to be used for read, write checks
+        data = "23"
+
+        object_store = self.object_store
+        assert is_empty(object_store.refs)
+
+        with object_store.new() as tree:
+            with tree.write() as path, \
+                    open(os.path.join(path, "data"), "w", encoding="utf8") as f:
+                f.write(data)
+                st = os.fstat(f.fileno())
+                data_inode = st.st_ino
+            # commit the object as "x"
+            object_store.commit(tree, "x")
+            # after the commit, "x" is now the base
+            # of "tree"
+            self.assertEqual(tree.base, "x")
+            # check that "data" is still the very
+            # same file after committing
+            with tree.read() as path:
+                with open(os.path.join(path, "data"), "r", encoding="utf8") as f:
+                    st = os.fstat(f.fileno())
+                    self.assertEqual(st.st_ino, data_inode)
+                    data_read = f.read()
+                    self.assertEqual(data, data_read)
+
+        # the object referenced by "x" should act as
+        # the base of a new object. As long as the
+        # new one is not modified, it should have
+        # the very same content
+        with object_store.new(base_id="x") as tree:
+            self.assertEqual(tree.base, "x")
+            with tree.read() as path:
+                with open(os.path.join(path, "data"), "r", encoding="utf8") as f:
+                    # copy-on-write: since we have not written
+                    # to the tree yet, "data" should be the
+                    # very same file as that one of object "x"
+                    st = os.fstat(f.fileno())
+                    self.assertEqual(st.st_ino, data_inode)
+                    data_read = f.read()
+                    self.assertEqual(data, data_read)
+            with tree.write() as path:
+                # "data" must of course still be present
+                assert os.path.exists(os.path.join(path, "data"))
+                # but since it is a copy, have a different inode
+                st = os.stat(os.path.join(path, "data"))
+                self.assertNotEqual(st.st_ino, data_inode)
+                touch(os.path.join(path, "other_data"))
+
+
 @unittest.skipUnless(test.TestBase.can_bind_mount(), "root-only")
 class TestObjectStore(unittest.TestCase):
 
@@ -22,151 +197,18 @@ class TestObjectStore(unittest.TestCase):
         cls.store = os.getenv("OSBUILD_TEST_STORE")
         if not cls.store:
             cls.store = tempfile.mkdtemp(prefix="osbuild-test-", dir="/var/tmp")
+        cls.stack = contextlib.ExitStack()
+        store = objectstore.ObjectStore(cls.store)
+        cls.object_store = cls.stack.enter_context(store)
 
     @classmethod
     def tearDownClass(cls):
+        cls.stack.close()
         if not os.getenv("OSBUILD_TEST_STORE"):
             shutil.rmtree(cls.store)
 
-    def test_basic(self):
-        # always use a temporary store so item counting works
-        with tempfile.TemporaryDirectory(dir="/var/tmp") as tmp:
-            object_store = objectstore.ObjectStore(tmp)
-            # No objects or references should be in the store
-            assert len(os.listdir(object_store.refs)) == 0
-            assert len(os.listdir(object_store.objects)) == 0
-
-            with object_store.new() as tree:
-                with tree.write() as path:
-                    p = Path(path, "A")
-                    p.touch()
-                object_store.commit(tree, "a")
-
-            assert object_store.contains("a")
-            assert os.path.exists(f"{object_store.refs}/a")
-            assert os.path.exists(f"{object_store.refs}/a/A")
-            assert len(os.listdir(object_store.refs)) == 1
-            assert len(os.listdir(object_store.objects)) == 1
-            assert len(os.listdir(f"{object_store.refs}/a/")) == 1
-
-            with object_store.new() as tree:
-                with tree.write() as path:
-                    p = Path(path, "A")
-                    p.touch()
-                    p = Path(path, "B")
-                    p.touch()
-                object_store.commit(tree, "b")
-
-            assert object_store.contains("b")
-            assert os.path.exists(f"{object_store.refs}/b")
-            assert os.path.exists(f"{object_store.refs}/b/B")
-
-            assert len(os.listdir(object_store.refs)) == 2
-            assert len(os.listdir(object_store.objects)) == 2
-            assert len(os.listdir(f"{object_store.refs}/b/")) == 2
-
-            self.assertEqual(object_store.resolve_ref(None), None)
-            self.assertEqual(object_store.resolve_ref("a"),
-                             f"{object_store.refs}/a")
-
-    def test_cleanup(self):
-        # always use a temporary store so item counting works
-        with tempfile.TemporaryDirectory(dir="/var/tmp") as tmp:
-            with objectstore.ObjectStore(tmp) as object_store:
-                tree = object_store.new()
-                self.assertEqual(len(os.listdir(object_store.tmp)), 1)
-                with tree.write() as path:
-                    p = Path(path, "A")
-                    p.touch()
-            # there should be no temporary Objects dirs anymore
-            self.assertEqual(len(os.listdir(object_store.tmp)), 0)
-
-    # pylint: disable=no-self-use
-    def test_object_base(self):
-        # operate with a clean object store
-        with tempfile.TemporaryDirectory(dir="/var/tmp") as tmp:
-            object_store = objectstore.ObjectStore(tmp)
-            with object_store.new() as tree:
-                with tree.write() as path:
-                    p = Path(path, "A")
-                    p.touch()
-                object_store.commit(tree, "a")
-
-            with object_store.new() as tree:
-                tree.base = "a"
-                object_store.commit(tree, "b")
-
-            with object_store.new() as tree:
-                tree.base = "b"
-                with tree.write() as path:
-                    p = Path(path, "C")
-                    p.touch()
-                object_store.commit(tree, "c")
-
-            assert os.path.exists(f"{object_store.refs}/a/A")
-            assert os.path.exists(f"{object_store.refs}/b/A")
-            assert os.path.exists(f"{object_store.refs}/c/A")
-            assert os.path.exists(f"{object_store.refs}/c/C")
-
-            assert len(os.listdir(object_store.refs)) == 3
-            assert len(os.listdir(object_store.objects)) == 3
-
-    def test_object_copy_on_write(self):
-        # operate with a clean object store
-        with tempfile.TemporaryDirectory(dir="/var/tmp") as tmp:
-            # sample data to be used for read, write checks
-            data = "23"
-
-            object_store = objectstore.ObjectStore(tmp)
-            assert len(os.listdir(object_store.refs)) == 0
-
-            with object_store.new() as tree:
-                path = tree.write()
-                with tree.write() as path, \
-                        open(os.path.join(path, "data"), "w", encoding="utf8") as f:
-                    f.write(data)
-                    st = os.fstat(f.fileno())
-                    data_inode = st.st_ino
-                # commit the object as "x"
-                object_store.commit(tree, "x")
-                # after the commit, "x" is now the base
-                # of "tree"
-                self.assertEqual(tree.base, "x")
-                # check that "data" is still the very
-                # same file after committing
-                with tree.read() as path:
-                    with open(os.path.join(path, "data"), "r", encoding="utf8") as f:
-                        st = os.fstat(f.fileno())
-                        self.assertEqual(st.st_ino, data_inode)
-                        data_read = f.read()
-                        self.assertEqual(data, data_read)
-
-            # the object referenced by "x" should act as
-            # the base of a new object. As long as the
-            # new one is not modified, it should have
-            # the very same content
-            with object_store.new(base_id="x") as tree:
-                self.assertEqual(tree.base, "x")
-                with tree.read() as path:
-                    with open(os.path.join(path, "data"), "r", encoding="utf8") as f:
-                        # copy-on-write: since we have not written
-                        # to the tree yet, "data" should be the
-                        # very same file as that one of object "x"
-                        st = os.fstat(f.fileno())
-                        self.assertEqual(st.st_ino, data_inode)
-                        data_read = f.read()
-                        self.assertEqual(data, data_read)
-                with tree.write() as path:
-                    # "data" must of course still be present
-                    assert os.path.exists(os.path.join(path, "data"))
-                    # but since it is a copy, have a different inode
-                    st = os.stat(os.path.join(path, "data"))
-                    self.assertNotEqual(st.st_ino, data_inode)
-                    p = Path(path, "other_data")
-                    p.touch()
-
     def test_object_mode(self):
-        object_store = objectstore.ObjectStore(self.store)
+        object_store = self.object_store
         with object_store.new() as tree:
             # check that trying to write to a tree that is
             # currently being read from fails
@@ -218,17 +260,15 @@ class TestObjectStore(unittest.TestCase):
                 pass
 
     def test_snapshot(self):
-        object_store = objectstore.ObjectStore(self.store)
+        object_store = self.object_store
         with object_store.new() as tree:
             with tree.write() as path:
-                p = Path(path, "A")
-                p.touch()
+                touch(os.path.join(path, "A"))
             assert not object_store.contains("a")
             object_store.commit(tree, "a")
             assert object_store.contains("a")
             with tree.write() as path:
-                p = Path(path, "B")
-                p.touch()
+                touch(os.path.join(path, "B"))
             object_store.commit(tree, "b")
 
         # check the references exist
@@ -236,15 +276,14 @@ class TestObjectStore(unittest.TestCase):
         assert os.path.exists(f"{object_store.refs}/b")
 
         # check the contents of the trees
-        assert os.path.exists(f"{object_store.refs}/a/A")
-        assert not os.path.exists(f"{object_store.refs}/a/B")
+        assert store_path(object_store, "a", "A")
+        assert not store_path(object_store, "a", "B")
 
-        assert os.path.exists(f"{object_store.refs}/b/A")
-        assert os.path.exists(f"{object_store.refs}/b/B")
+        assert store_path(object_store, "b", "A")
+        assert store_path(object_store, "b", "B")
 
     def test_host_tree(self):
-        object_store = objectstore.ObjectStore(self.store)
-        host = objectstore.HostTree(object_store)
+        host = objectstore.HostTree(self.object_store)
 
         # check we cannot call `write`
         with self.assertRaises(ValueError):
@@ -253,20 +292,17 @@ class TestObjectStore(unittest.TestCase):
 
         # check we actually cannot write to the path
         with host.read() as path:
-            p = Path(path, "osbuild-test-file")
             with self.assertRaises(OSError):
-                p.touch()
+                touch(os.path.join(path, "osbuild-test-file"))
 
     # pylint: disable=too-many-statements
     def test_store_server(self):
 
         with contextlib.ExitStack() as stack:
 
-            store = objectstore.ObjectStore(self.store)
-            stack.enter_context(stack)
+            store = self.object_store
 
-            tmpdir = tempfile.TemporaryDirectory()
-            tmpdir = stack.enter_context(tmpdir)
+            tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
 
             server = objectstore.StoreServer(store)
             stack.enter_context(server)
@@ -288,42 +324,38 @@ class TestObjectStore(unittest.TestCase):
 
             obj = store.new()
             with obj.write() as path:
-                p = Path(path, "file.txt")
-                p.write_text("osbuild")
+                filepath = os.path.join(path, "file.txt")
+                with open(filepath, "w", encoding="utf8") as f:
+                    f.write("osbuild")
 
-                p = Path(path, "directory")
-                p.mkdir()
+                os.mkdir(os.path.join(path, "directory"))
 
             obj.id = "42"
 
-            mountpoint = Path(tmpdir, "mountpoint")
-            mountpoint.mkdir()
+            mountpoint = os.path.join(tmpdir, "mountpoint")
+            os.mkdir(mountpoint)
 
             assert store.contains("42")
             path = client.read_tree_at("42", mountpoint)
-            assert Path(path) == mountpoint
-            filepath = Path(mountpoint, "file.txt")
-            assert filepath.exists()
-            txt = filepath.read_text(encoding="utf8")
-            assert txt == "osbuild"
+            assert path == mountpoint
+            filepath = os.path.join(mountpoint, "file.txt")
+            assert read_raw(filepath) == b"osbuild"
 
             # check we can mount subtrees via `read_tree_at`
 
-            filemount = Path(tmpdir, "file")
-            filemount.touch()
+            filemount = os.path.join(tmpdir, "file")
+            touch(filemount)
 
             path = client.read_tree_at("42", filemount, "/file.txt")
-            filepath = Path(path)
-            assert filepath.is_file()
-            txt = filepath.read_text(encoding="utf8")
-            assert txt == "osbuild"
+            assert path == filemount
+            assert read_raw(path) == b"osbuild"
 
-            dirmount = Path(tmpdir, "dir")
-            dirmount.mkdir()
+            dirmount = os.path.join(tmpdir, "dir")
+            os.mkdir(dirmount)
 
             path = client.read_tree_at("42", dirmount, "/directory")
-            dirpath = Path(path)
-            assert dirpath.is_dir()
+            assert path == dirmount
+            assert os.path.isdir(path)
 
             # check proper exceptions are raised for non existent
             # mount points and sub-trees